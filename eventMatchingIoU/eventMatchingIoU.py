@@ -14,8 +14,7 @@
         2019-07-24
 """
 import numpy as np
-import pandas as pd
-import copy
+from numba import njit, prange
 
 
 def event_level_f1_score(hits,false_alarm,miss):
@@ -68,6 +67,7 @@ def eventLevelMatchingIoU(gt,alg,IoU_threshold = 0.5,label_names = None,event_ty
             output_2 : A dict comprised the dicts for each event type and the overall result. It contains the f1-score and number of hits, false alarms type 1 and type 2 and misses.
                        It also contains the arrays that show which events where what type. So the array [event_type_name+'_hit'] contains 1's for the events 
                        that were a hit and 0 for those that werent, while event_type_name+'_hit_counter' is the number of hits.
+                       The hit, false alarm and miss arrays are int8 and the IoU arrays are float32.
     
         References:
         ----------
@@ -76,156 +76,49 @@ def eventLevelMatchingIoU(gt,alg,IoU_threshold = 0.5,label_names = None,event_ty
             Behavior Research Methods.
   '''
    
-  # They need to be panda series because index manipulation is easier in pandas
-  if type(gt) is not pd.Series():
-    gt = pd.Series(gt)
-  if type(alg) is not pd.Series():
-    alg = pd.Series(alg)
-  output = []
+  # Convert once at entry, the event types are only ever compared against the compact event labels
+  gt = np.ascontiguousarray(gt,dtype=np.int32)
+  alg = np.ascontiguousarray(alg,dtype=np.int32)
   output_2 = dict()
+  # Events are handled by their start, end and label so only the event tables are traversed, not the samples
+  gt_starts, gt_ends, gt_labels = getEventStartsAndEnds(gt)
+  alg_starts, alg_ends, alg_labels = getEventStartsAndEnds(alg)
   if event_types is None:
-      event_types = np.union1d(np.unique(gt),np.unique(alg))
-  gt_event_number, gt_event_start,gt_event_end = getEventStartsAndEnds(gt)
-  gt_event_number = pd.Series(gt_event_number)
-  alg_event_number, alg_event_start,alg_event_end = getEventStartsAndEnds(alg)
-  alg_event_number = pd.Series(alg_event_number)
+      # The event labels hold every label value, but are far shorter than the sample level labels
+      event_types = np.union1d(gt_labels,alg_labels)
+
+  (hit_arrays,false_positive_arrays,false_positive_type_2_arrays,miss_arrays,
+   counters,IoU_arrays) = _match_all_event_types(gt_starts,gt_ends,gt_labels,alg_starts,alg_ends,alg_labels,
+                                                  np.asarray(event_types,dtype=np.int64),
+                                                  float(IoU_threshold),len(gt))
   for i_label_name,event_type in enumerate(event_types,start=0):
     #print('label name: ',i_label_name,' event type: ',event_type )
     
-    gt_current_event = copy.deepcopy(gt)
-    gt_current_event[gt!=event_type] = 0
-    gt_current_event[gt==event_type] = 1
-
-    alg_current_event = copy.deepcopy(alg)
-    alg_current_event[alg!=event_type] = 0
-    alg_current_event[alg==event_type] = 1
-
-
-    hit = np.zeros(len(gt))
-    false_positive = np.zeros(len(gt))
-    false_positive_type_2 = np.zeros(len(gt))
-    miss = np.zeros(len(gt))
-    IoU_array = np.zeros(len(gt))
-    
-    # Keep track of what events have already been labelled
-    already_assigned_label_alg = np.zeros(len(gt)) # Need to be finished
-    already_assigned_label_gt = np.zeros(len(gt)) # Need to be finished
-
-    hit_counter = 0
-    false_positive_counter = 0
-    miss_counter = 0
-    for event in np.unique(gt_event_number[gt_current_event==1]):
-      gt_event = gt_current_event[gt_event_number==event]
-      alg_events = alg_current_event[gt_event.index]
-      number_of_same_samples_detected = gt_event == alg_events
-      number_of_alg_events_occuring_during_gt_event = np.unique((alg_event_number.where(number_of_same_samples_detected).dropna()))
-      #print(number_of_alg_events_occuring_during_gt_event.min())
-      # Count the number of misses
-
-      if number_of_alg_events_occuring_during_gt_event.size == 0:
-        #print('label name: ',i_label_name,' event type: ',event_type,
-        #      'numer overlapping events: ',number_of_alg_events_occuring_during_gt_event,' ',number_of_alg_events_occuring_during_gt_event.size,
-        #      ' ',number_of_same_samples_detected)
-        miss_counter = miss_counter + 1
-        miss[gt_event.index] = 1
-        already_assigned_label_gt[gt_event.index] = 1
-        
-      else:
-        for alg_event_during_gt in number_of_alg_events_occuring_during_gt_event:
-          gt_event_being_evaluated_index = gt_event_number[gt_event_number==event].index
-          alg_event_being_evaluated_index = alg_event_number[alg_event_number==alg_event_during_gt].index
-          if all(already_assigned_label_alg[alg_event_being_evaluated_index]==1):  
-              # Skip events in the algorithm that have already been labelled, so they don't get labelled twice
-              #print('skip',event_type,alg_event_during_gt)
-              #print(alg_event_being_evaluated_index)
-              None
-          else:
-              union = np.union1d(gt_event_being_evaluated_index,alg_event_being_evaluated_index)
-              intersection = np.intersect1d(gt_event_being_evaluated_index,alg_event_being_evaluated_index)
-              IoU = len(intersection)/len(union)
-              if IoU > IoU_threshold:
-                hit_counter = hit_counter +1
-                hit[gt_event.index] = 1
-                IoU_array[gt_event.index] = IoU
-                already_assigned_label_gt[gt_event.index] = 1
-                already_assigned_label_alg[alg_event_being_evaluated_index]=1
-              else:
-                false_positive_counter = false_positive_counter +1
-                false_positive[alg_event_being_evaluated_index] = 1
-                already_assigned_label_alg[alg_event_being_evaluated_index] = 1
-              #already_assigned_label_alg[alg_event_being_evaluated_index]=1 # Keep track of algorithm event that have already been evaluated
-
-        # Any ground truth events that were not a hit are set as misses
-        if any(already_assigned_label_gt[gt_event.index] == 0):
-            #print('label name: ',i_label_name,' event type: ',event_type,
-            #  'numer unmatched events: ', already_assigned_label_gt)
-            miss_counter = miss_counter + 1 # Lee's version
-            miss[gt_event.index] = 1 # Lee's version 
-            already_assigned_label_gt[gt_event.index] = 1
-        
-        # Get the unmatched event from the algorithm stream
-        #print(np.unique(alg_current_event[alg_current_event==1]))
-    # Count the number false alarms where an event occurs in the algorithm stream but not in the ground truth
-    for alg_event_during_not_during_gt in np.unique(alg_event_number[alg_current_event==1]):
-        if any(already_assigned_label_alg[alg_event_number[alg_event_number==alg_event_during_not_during_gt].index]==0):
-            false_positive_counter = false_positive_counter +1
-            false_positive_type_2[alg_event_number[alg_event_number==alg_event_during_not_during_gt].index] = 1  
-            hit[alg_event_number[alg_event_number==alg_event_during_not_during_gt].index] = 0
-            #already_assigned_label_alg[alg_event_number[alg_event_number==alg_event_during_not_during_gt].index] = 1
-            #print("unmatched",i_label_name)
-    '''
-    for alg_event_during_not_during_gt in np.unique(alg_event_number[alg_current_event==1]):
-      alg_event_being_evaluated_index = alg_event_number[alg_event_number==alg_event_during_not_during_gt].index
-      if  ((all(hit[alg_event_being_evaluated_index]==0)) &
-          (all(false_positive[alg_event_being_evaluated_index]==0)) &
-          (all(miss[alg_event_being_evaluated_index]==0))):
-          #false_positive_counter = false_positive_counter +1
-          #false_positive_type_2[alg_event_being_evaluated_index] = 1    
-          None
-          None
-    '''
+    hit_counter,false_positive_counter,miss_counter = (int(count) for count in counters[i_label_name])
     if label_names is None:
       event_type_name = str(event_type)
     else:
       event_type_name = label_names[i_label_name]
-    output_dict = {event_type_name+'_hit':hit,
-                   event_type_name+'_false_positive':false_positive,
-                   event_type_name+'_false_positive_type_2':false_positive_type_2,
-                   event_type_name+'_miss':miss,
+    output_dict = {event_type_name+'_hit':hit_arrays[i_label_name],
+                   event_type_name+'_false_positive':false_positive_arrays[i_label_name],
+                   event_type_name+'_false_positive_type_2':false_positive_type_2_arrays[i_label_name],
+                   event_type_name+'_miss':miss_arrays[i_label_name],
                    event_type_name+'_hit_count':hit_counter,
                    event_type_name+'_false_positive_count':false_positive_counter,
                    event_type_name+'_miss_count':miss_counter,
-                   event_type_name+'_hits_IoU':IoU_array,
+                   event_type_name+'_hits_IoU':IoU_arrays[i_label_name],
                    event_type_name+'_f1_score':event_level_f1_score(hit_counter,false_positive_counter,miss_counter)}
   
-    output.append(output_dict)
     output_2.update({event_type_name:output_dict})
-    
-  overall_hit =np.zeros(len(gt))
-  overall_false_positive = np.zeros(len(gt))
-  overall_false_positive_2 = np.zeros(len(gt))
-  overall_miss =np.zeros(len(gt))
-  overall_hit_counter =0
-  overall_false_positive_counter = 0
-  overall_miss_counter = 0
-  overall_IoU = np.zeros(len(gt))
 
-  if label_names is None:
-    event_type_names = [str(ii) for ii in event_types]
-  else:
-    event_type_names = label_names     
-    
-  for ii,event_type_name in zip(output,event_type_names):
-    print('event_type_name: ',event_type_name)
-    overall_hit[ii[event_type_name+'_hit']!= 0] = 1
-    overall_false_positive[ii[event_type_name+'_false_positive']!=0] = 1
-    overall_miss[ii[event_type_name+'_miss']!= 0] = 1
-    overall_false_positive_2[ii[event_type_name+'_false_positive_type_2']!= 0] = 1
-    overall_hit_counter = overall_hit_counter + ii[event_type_name+'_hit_count']
-    overall_false_positive_counter = overall_false_positive_counter + ii[event_type_name+'_false_positive_count']
-    overall_miss_counter = overall_miss_counter + ii[event_type_name+'_miss_count']
-    overall_IoU= overall_IoU+ii[event_type_name+'_hits_IoU']
-  
+  # Every event type wrote its own row, so the overall result is a reduction over the rows
+  overall_hit = np.bitwise_or.reduce(hit_arrays,axis=0)
+  overall_false_positive = np.bitwise_or.reduce(false_positive_arrays,axis=0)
+  overall_false_positive_2 = np.bitwise_or.reduce(false_positive_type_2_arrays,axis=0)
+  overall_miss = np.bitwise_or.reduce(miss_arrays,axis=0)
+  overall_hit_counter,overall_false_positive_counter,overall_miss_counter = (int(count) for count in counters.sum(axis=0))
+  overall_IoU = IoU_arrays.sum(axis=0,dtype=np.float32)
+
   #overall_hit[np.where(overall_false_positive_2==1)]=0 # Set all hit samples during  false positives of type 2  to be 0
 
   output_dict = {}
@@ -241,43 +134,172 @@ def eventLevelMatchingIoU(gt,alg,IoU_threshold = 0.5,label_names = None,event_ty
                                                          overall_false_positive_counter,
                                                          overall_miss_counter)}
 
-  # output_2 is the same as output except it is in a dict instead of a list
-  output.append(output_dict)
   output_2.update({'overall':output_dict})
   return output_2
 
+@njit('Tuple((int64,int64,int64))(int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],int64,float64,'
+      'int8[::1],int8[::1],int8[::1],int8[::1],float32[::1])',cache=True)
+def _match_events_core(gt_starts,gt_ends,gt_labels,alg_starts,alg_ends,alg_labels,event_type,IoU_threshold,
+                       hit,false_positive,false_positive_type_2,miss,IoU_array):
+  '''
+      Compiled core of eventLevelMatchingIoU that matches the events of a single event type.
+      The event tables are sorted, so the algorithm events overlapping each ground truth event are found by binary search.
+      
+      Parameters:
+      -----------
+            gt_starts, gt_ends, gt_labels    : The ground truth events from getEventStartsAndEnds.
+            alg_starts, alg_ends, alg_labels : The algorithm events from getEventStartsAndEnds.
+            event_type   : The label of the events that are matched.
+            IoU_threshold : The Intersecion over Union threshold which determines the acceptable overlap for a hit.
+            hit, false_positive, false_positive_type_2, miss, IoU_array : Zeroed sample level arrays that are filled in.
+    
+        Returns:
+        --------
+            The hit, false positive and miss counts.
+  '''
+  # The events of the current event type, the algorithm starts and ends are still sorted after selecting them
+  gt_events = np.flatnonzero(gt_labels == event_type)
+  alg_events = np.flatnonzero(alg_labels == event_type)
+  alg_type_starts = alg_starts[alg_events]
+  alg_type_ends = alg_ends[alg_events]
+
+  # Keep track of what algorithm events have already been labelled
+  alg_claimed = np.zeros(alg_events.shape[0],np.bool_)
+
+  hit_counter = 0
+  false_positive_counter = 0
+  miss_counter = 0
+  for gt_event in gt_events:
+    gt_start = gt_starts[gt_event]
+    gt_end = gt_ends[gt_event]
+    gt_claimed = False
+    # The ends are sorted, so the first algorithm event that overlaps is found by binary search
+    alg_event = np.searchsorted(alg_type_ends,gt_start)
+    while alg_event < alg_events.shape[0] and alg_type_starts[alg_event] <= gt_end:
+      alg_start = alg_type_starts[alg_event]
+      alg_end = alg_type_ends[alg_event]
+      if alg_claimed[alg_event]:
+        # Skip events in the algorithm that have already been labelled, so they don't get labelled twice
+        alg_event += 1
+        continue
+      intersection = min(gt_end,alg_end) - max(gt_start,alg_start) + 1
+      union = (gt_end-gt_start+1) + (alg_end-alg_start+1) - intersection
+      IoU = intersection/union
+      if IoU > IoU_threshold:
+        hit_counter += 1
+        hit[gt_start:gt_end+1] = 1
+        IoU_array[gt_start:gt_end+1] = IoU
+        gt_claimed = True
+        alg_claimed[alg_event] = True
+      else:
+        false_positive_counter += 1
+        false_positive[alg_start:alg_end+1] = 1
+        alg_claimed[alg_event] = True
+      alg_event += 1
+
+    # Any ground truth events that were not a hit are set as misses
+    if not gt_claimed:
+      miss_counter += 1
+      miss[gt_start:gt_end+1] = 1
+
+  # Count the number false alarms where an event occurs in the algorithm stream but not in the ground truth
+  for alg_event in range(alg_events.shape[0]):
+    if alg_claimed[alg_event]:
+      continue
+    alg_start = alg_type_starts[alg_event]
+    alg_end = alg_type_ends[alg_event]
+    false_positive_counter += 1
+    false_positive_type_2[alg_start:alg_end+1] = 1
+    hit[alg_start:alg_end+1] = 0
+  return hit_counter,false_positive_counter,miss_counter
+
+@njit('Tuple((int8[:,::1],int8[:,::1],int8[:,::1],int8[:,::1],int64[:,::1],float32[:,::1]))'
+      '(int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],int32[::1],int64[::1],float64,int64)',parallel=True,cache=True)
+def _match_all_event_types(gt_starts,gt_ends,gt_labels,alg_starts,alg_ends,alg_labels,event_types,IoU_threshold,number_of_samples):
+  '''
+      Matches every event type in parallel. The event types are independent, so each one writes
+      its own row of the output arrays.
+      
+        Returns:
+        --------
+            The hit, false positive, false positive type 2 and miss arrays with a row per event type, the hit, false positive
+            and miss counts with a row per event type and the IoU arrays with a row per event type.
+  '''
+  number_of_event_types = event_types.shape[0]
+  hit = np.zeros((number_of_event_types,number_of_samples),np.int8)
+  false_positive = np.zeros((number_of_event_types,number_of_samples),np.int8)
+  false_positive_type_2 = np.zeros((number_of_event_types,number_of_samples),np.int8)
+  miss = np.zeros((number_of_event_types,number_of_samples),np.int8)
+  counters = np.zeros((number_of_event_types,3),np.int64)
+  IoU_array = np.zeros((number_of_event_types,number_of_samples),np.float32)
+  for i_event_type in prange(number_of_event_types):
+    hit_counter,false_positive_counter,miss_counter = _match_events_core(gt_starts,gt_ends,gt_labels,
+                                                                         alg_starts,alg_ends,alg_labels,
+                                                                         event_types[i_event_type],IoU_threshold,
+                                                                         hit[i_event_type],false_positive[i_event_type],
+                                                                         false_positive_type_2[i_event_type],miss[i_event_type],
+                                                                         IoU_array[i_event_type])
+    counters[i_event_type,0] = hit_counter
+    counters[i_event_type,1] = false_positive_counter
+    counters[i_event_type,2] = miss_counter
+  return hit,false_positive,false_positive_type_2,miss,counters,IoU_array
+
 def getEventStartsAndEnds(labelled_event):
   '''
       Helper function to get the starts and ends of events from a sample level array of labels
       Parameters:
       -----------
-            labelled_event  : a numpy array of labels at a sample level
+            labelled_event  : a numpy array of integer labels at a sample level
                               E.g:
                                   [0,0,0,1,1,1,3,3,3,0,0,0,2,2,2,2]
 
     
         Returns:
         --------
-            event_numbers : An array the size of the labelled_event that contains the event number at each index. 
-            event_start   : An array that contains the index of when an event starts.
-            event_end     : An array that contains the index of when an event ends.
+            event_start : An int32 array that contains the index of when an event starts.
+                          E.g:
+                              [0,3,6,9,12]
+            event_end   : An int32 array that contains the index of when an event ends.
+                          E.g:
+                              [2,5,8,11,15]
+            labels      : An int32 array with the label of each event.
+                          E.g:
+                              [0,1,3,0,2]
   '''
-  event_start = np.where(np.roll(labelled_event,1)!=labelled_event)[0]
-  if event_start.size == 0:
-      return 0,None,None
-  if event_start[0] != 0:
-      event_start = np.insert(event_start,0,0) # Add start of the first event in the case where the first and alst even are the same
-  event_end = np.roll(event_start,-1)
-  event_end[-1] = len(labelled_event) # Add the end of the last event (0 indexing should get yeeted) (threw away -1)
-  event_end = event_end-1 # shift everything down 1 index then an event ends right before another starts
-  event_numbers = np.zeros(len(labelled_event))
-  
-  for event_number,(start,end) in enumerate(zip(event_start,event_end),start=1):
-    if start == end:
-      event_numbers[start] = event_number
-    else:
-      event_numbers[start:end+1] = event_number
-  return event_numbers, event_start,event_end 
+  return _starts_ends(np.ascontiguousarray(labelled_event,dtype=np.int32))
+
+@njit('Tuple((int32[::1],int32[::1],int32[::1]))(int32[::1])',cache=True)
+def _starts_ends(labelled_event):
+  '''
+      Compiled body of getEventStartsAndEnds. The label changes are counted first so the event table
+      can be allocated at its final size, then a second pass fills in the starts, ends and labels.
+  '''
+  number_of_samples = labelled_event.shape[0]
+  number_of_events = 0
+  if number_of_samples > 0:
+    number_of_events = 1
+  for i in range(1,number_of_samples):
+    if labelled_event[i] != labelled_event[i-1]:
+      number_of_events += 1
+
+  event_start = np.empty(number_of_events,np.int32)
+  event_end = np.empty(number_of_events,np.int32)
+  labels = np.empty(number_of_events,np.int32)
+  event = 0
+  start = 0
+  for i in range(1,number_of_samples):
+    if labelled_event[i] != labelled_event[i-1]:
+      event_start[event] = start
+      event_end[event] = i-1
+      labels[event] = labelled_event[start]
+      event += 1
+      start = i
+  if number_of_events > 0:
+    # Close the last event, which runs to the end of the array
+    event_start[event] = start
+    event_end[event] = number_of_samples-1
+    labels[event] = labelled_event[start]
+  return event_start, event_end, labels
 
 if __name__=='__main__':
     '''
@@ -11,6 +11,6 @@ setup(
     url='https://github.com/Kongskrald/Eye-movement-event-level-matching-with-IoU',
     packages=find_packages(),
     python_requires=">=3.6",
-    install_requires=['numpy>=1.14.5','pandas>=0.23.4'],
+    install_requires=['numpy>=1.14.5','numba>=0.45.0'],
     include_package_data=True,
 )
\ No newline at end of file